@@ -12,11 +12,13 @@ https://github.com/EdjeElectronics/TensorFlow-Lite-Object-Detection-on-Android-a
 
 import logging as log          # Log messages and log file output
 import os                      # Operating system commands
+import subprocess              # Running external programs
 import time                    # Timing functions
 from datetime import datetime  # Real-world date and time
+from collections import deque  # Double-ended queue
 import cv2                     # OpenCV functions
 import numpy as np             # Matrix operations
-from threading import Thread   # Concurrency
+from threading import Thread, Lock, Condition, Event # Concurrency
 import settings
 
 ### Constants ###
@@ -25,7 +27,34 @@ CAMERA_INDEX  = 0                # Index of the camera to use (there is only one
 WIDTH, HEIGHT = 1280, 720        # Image dimensions in pixels
 RESOLUTION    = (WIDTH, HEIGHT)  # Tuple version for convenience
 WINDOW_TITLE  = "Camera Preview" # Title of the preview window when in developer mode
+PREVIEW_FRAMERATE = 10           # Maximum rate to update the preview window at, it doesn't need to be smooth
+FIRST_FRAME_TIMEOUT = 5          # Maximum time in seconds to wait for the camera to deliver its first frame when opened
 TEXT_COLOUR   = (255, 255, 255)  # Colour of the text at the top of the frame
+BOX_COLOUR    = (10, 255, 0)     # Colour of the detection boxes
+LABEL_COLOUR  = (255, 255, 255)  # Background colour of the detection labels
+LABEL_TEXT_COLOUR = (0, 0, 0)    # Colour of the text in the detection labels
+
+# Bound once here rather than looked up from the cv2 module every time they are used
+FONT    = cv2.FONT_HERSHEY_SIMPLEX
+LINE_AA = cv2.LINE_AA
+
+# Multiplying the detector's normalised [ymin, xmin, ymax, xmax] boxes by this gives pixel coordinates, and it doubles as
+# the upper limit when clipping them to the image dimensions
+BOX_SCALE = np.array([HEIGHT, WIDTH, HEIGHT, WIDTH], dtype = np.float32)
+
+# Whether to use OpenCL to do the image processing on the GPU, if it's available (it isn't on the pi)
+USE_OPENCL = cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(USE_OPENCL)
+
+# GStreamer pipeline used to encode videos with the pi's hardware H.264 encoder rather than on the CPU; frames from the
+# video writer come in through appsrc and are saved to the file given by the location placeholder
+# N.B. This saves to a Matroska (.mkv) file rather than an mp4, because an mp4 can't be played at all unless the index at
+# the end gets written when the file is closed, whereas a Matroska file is still playable up to wherever it got to if the
+# pi loses power or is forced to shut down in the middle of a capture
+H264_PIPELINE = "appsrc ! videoconvert ! v4l2h264enc ! video/x-h264,level=(string)4 ! h264parse ! matroskamux ! filesink location={}"
+
+FFMPEG_BUFFER_SIZE = 8 << 20 # Size of the buffer for piping frames to ffmpeg in bytes (8MB, i.e. about 3 frames)
+ENCODER_THREADS = os.cpu_count() or 1 # Number of threads to use for CPU video encoding (1 per core)
 
 INACTIVE_SCREEN = np.zeros((HEIGHT, WIDTH, 3), dtype = "uint8") # Just a black screen for now (only used in dev mode)
 
@@ -43,7 +72,9 @@ class FrameBuffer():
         # This is done in a numpy array because they are more memory-efficient. Although a queue (or deque) would be a bit
         # faster to push/pop elements, the limiting factor here is space rather than processing time.
         # We need 1 extra space so that we can tell the difference between empty and full!
-        self.array = np.zeros((max_size + 1, height, width, 3), dtype = "uint8") # Specify uint8 to save space
+        # There's no need to zero the array since every slot gets overwritten by push() before it is read
+        self.array = np.empty((max_size + 1, height, width, 3), dtype = "uint8") # Specify uint8 to save space
+        self.frame_shape = self.array.shape[1:] # Stored so push() doesn't have to make a view of a slot to check it
         self.write_index = 0
         self.read_index = 0
         self.max_size = max_size
@@ -54,6 +85,37 @@ class FrameBuffer():
         """
         return self.write_index == self.read_index
         
+    def get_write_slot(self):
+        """
+        Returns the slot at the end of the queue so that the next frame can be written into it directly, without having to
+        copy it in afterwards. The frame is not added to the queue until commit() is called.
+        
+        Returns:
+        - The slot to write the next frame into, or None if the queue is full
+        """
+        # Check the next writer index the same way as commit() (see below)
+        # N.B. This also means the slot returned is never the one most recently popped, which the reader may still be using
+        # - that slot is only next in line for writing when the buffer is full (see pop())
+        if (self.write_index + 1 if self.write_index < self.max_size else 0) == self.read_index: return None # Buffer full
+        
+        return self.array[self.write_index]
+        
+    def commit(self):
+        """
+        Adds the frame that was written into the slot returned by get_write_slot() to the end of the queue.
+        
+        Returns:
+        - True if the frame was successfully enqueued, False if the queue was already full
+        """
+        # Increment writer index or loop back round to 0 - this is done with a comparison rather than a modulo because it's
+        # cheaper, and unlike a bitmask it doesn't need the buffer size to be a power of 2 (which would waste a lot of memory)
+        next_index = self.write_index + 1 if self.write_index < self.max_size else 0
+        if next_index == self.read_index: return False # Buffer full
+        
+        self.write_index = next_index
+        
+        return True
+        
     def push(self, frame):
         """
         Adds the given frame to the end of the queue if there is space.
@@ -69,26 +131,308 @@ class FrameBuffer():
         - TypeError: if the given frame is not of type uint8
         """
         
-        if frame.shape != self.array[0].shape: raise IndexError("Frame dimensions are not compatible")
+        if frame.shape != self.frame_shape: raise IndexError("Frame dimensions are not compatible")
         if frame.dtype != self.array.dtype: raise TypeError("Frame must be of type uint8")
         
-        # The part before the >= operator gives the number of frames in the buffer
-        if (self.write_index - self.read_index) % (self.max_size + 1) >= self.max_size: return False # Buffer full
-        
-        self.array[self.write_index] = frame # Store frame to buffer
-        self.write_index = (self.write_index + 1) % (self.max_size + 1) # Increment writer index or loop back round to 0
+        slot = self.get_write_slot()
+        if slot is None: return False # Buffer full
         
-        return True
+        np.copyto(slot, frame) # Store frame to buffer
+        return self.commit()
     
     def pop(self):
         """
-        Removes and returns the frame at the start of the queue. If the queue is empty, this will be all-zeros.
+        Removes and returns the frame at the start of the queue.
+        
+        N.B. The returned frame is a view of the slot in the buffer rather than a copy, so it is only valid until the next
+        call to pop(). This is safe because push() never writes to the most recently popped slot - when the buffer is
+        otherwise full, that slot is the extra space we use to tell the difference between empty and full.
+        
+        Raises:
+        - IndexError: if the queue is empty
         """
-        frame = np.copy(self.array[self.read_index]) # Must make a copy or it will be wiped by the next line
-        self.array[self.read_index] = 0 # Wipe the first position in the queue
-        self.read_index = (self.read_index + 1) % (self.max_size + 1) # Increment reader index or loop back round to 0
+        if self.is_empty(): raise IndexError("Cannot pop from an empty frame buffer")
+        
+        frame = self.array[self.read_index] # No need to copy or wipe the slot, the next push into it overwrites it anyway
+        self.read_index = self.read_index + 1 if self.read_index < self.max_size else 0 # Increment reader index or loop back round to 0
         return frame
 
+class CompressedFrameBuffer():
+    """
+    A frame buffer with the same methods as FrameBuffer, which stores frames JPEG-compressed rather than as raw pixels. This
+    uses a fraction of the RAM, at the cost of having to compress each frame when it is added and decompress it again
+    when it is removed.
+    """
+    
+    def __init__(self, max_size, width, height, quality):
+        """
+        Creates a new compressed frame buffer with the given parameters
+        """
+        self.frames = deque() # Appending and popping from opposite ends is thread-safe, so no lock is needed
+        self.max_size = max_size
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        # Frames are written into a staging slot and compressed from there, so these are the only full-size frames stored
+        # There are two so that they can be swapped each frame, otherwise the next frame would be written over the last one
+        # while it might still be being displayed in the preview window (see DisplayThread)
+        self.staging = [np.empty((height, width, 3), dtype = "uint8") for i in range(2)]
+        self.staging_index = 0
+        self.frame_shape = self.staging[0].shape
+        
+    def is_empty(self):
+        """
+        Returns True if the buffer contains no frames, False otherwise.
+        """
+        return not self.frames
+        
+    def get_write_slot(self):
+        """
+        Returns the slot to write the next frame into (see FrameBuffer.get_write_slot()), or None if the queue is full.
+        """
+        if len(self.frames) >= self.max_size: return None # Buffer full
+        return self.staging[self.staging_index]
+        
+    def commit(self):
+        """
+        Compresses the frame that was written into the slot returned by get_write_slot() and adds it to the end of the queue.
+        
+        Returns:
+        - True if the frame was successfully enqueued, False if the queue was already full or the frame couldn't be compressed
+        """
+        if len(self.frames) >= self.max_size: return False # Buffer full
+        success, data = cv2.imencode(".jpg", self.staging[self.staging_index], self.encode_params)
+        if not success: return False
+        self.frames.append(data)
+        self.staging_index = 1 - self.staging_index # Write the next frame into the other staging slot
+        return True
+        
+    def push(self, frame):
+        """
+        Adds the given frame to the end of the queue if there is space (see FrameBuffer.push()).
+        """
+        if frame.shape != self.frame_shape: raise IndexError("Frame dimensions are not compatible")
+        if frame.dtype != self.staging[0].dtype: raise TypeError("Frame must be of type uint8")
+        
+        slot = self.get_write_slot()
+        if slot is None: return False # Buffer full
+        
+        np.copyto(slot, frame) # Store frame to buffer
+        return self.commit()
+        
+    def pop(self):
+        """
+        Removes, decompresses and returns the frame at the start of the queue.
+        
+        Raises:
+        - IndexError: if the queue is empty
+        """
+        if self.is_empty(): raise IndexError("Cannot pop from an empty frame buffer")
+        return cv2.imdecode(self.frames.popleft(), cv2.IMREAD_COLOR)
+
+class FrameGrabber():
+    """
+    Continuously grabs frames from the camera stream in a separate thread, so that the main thread never has to wait for
+    the camera to deliver the next frame.
+    """
+    
+    def __init__(self, stream):
+        """
+        Creates a new frame grabber for the given camera stream. The grab thread is not started until start() is called.
+        """
+        self.stream = stream
+        self.lock = Lock()
+        self.frame_ready = Condition(self.lock) # Notified whenever a new frame has been grabbed
+        # Triple buffering: one frame being grabbed into, one waiting to be collected and one in use by the main thread
+        # These are swapped around by index so that frames never need to be copied between them
+        self.buffers = [np.empty((HEIGHT, WIDTH, 3), dtype = "uint8") for i in range(3)]
+        self.write_index = 0
+        self.latest_index = 1
+        self.read_index = 2
+        self.new_frame = False
+        self.frame_requested = True
+        self.stop_flag = False
+        self.thread = None
+        
+    def start(self):
+        """
+        Starts the grab thread. The stream must already be open.
+        """
+        self.stop_flag = False
+        self.new_frame = False
+        self.frame_requested = True
+        self.thread = Thread(target = self.run, args = (), name = "Frame-grab-thread", daemon = True)
+        self.thread.start()
+        
+    def stop(self):
+        """
+        Stops the grab thread and waits for it to finish, which must be done before the stream is released.
+        """
+        self.stop_flag = True
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        
+    def get_latest(self, timeout = 0):
+        """
+        Returns the most recently grabbed frame, or None if there hasn't been a new frame since the last call. The returned
+        frame belongs to the calling thread until the next call, after which it may be overwritten.
+        
+        This also requests that the next frame to be grabbed is decoded, ready for the next call. That means the frame
+        returned is the first one grabbed after the previous call rather than the very latest one, so it can be up to one
+        main loop period old (see run()).
+        
+        Parameters:
+        - timeout: Maximum time in seconds to wait for a new frame if there isn't one already (by default this doesn't wait)
+        """
+        with self.lock:
+            self.frame_requested = True
+            if not self.new_frame and timeout > 0: self.frame_ready.wait(timeout)
+            if not self.new_frame: return None
+            self.read_index, self.latest_index = self.latest_index, self.read_index
+            self.new_frame = False
+        return self.buffers[self.read_index]
+        
+    def run(self):
+        
+        log.debug("Frame grab thread started")
+        
+        failing = False # Only log when the camera starts or stops failing, not for every failed frame
+        
+        while not self.stop_flag:
+            
+            # This is equivalent to stream.read(), but split up so that frames are only decoded when they are actually going to be
+            # used - the camera keeps delivering frames either way, so grab() still needs calling to keep up with it
+            # The trade-off is that the frame handed over by get_latest() is the first one grabbed after the previous call,
+            # so it lags behind the camera by up to one main loop period (1/FRAMERATE, i.e. 100ms by default). That doesn't
+            # matter here - it's the same delay for every frame so the video is still smooth, and it's nothing compared to
+            # how long object detection takes - whereas decoding every frame the camera delivers (typically 30fps) would
+            # mean doing about 3 times as many conversions as we actually use
+            # Retrieving also lets us pass in our own buffer for the frame to be stored in; if the frame doesn't fit in the
+            # buffer OpenCV allocates a new one instead, so we keep hold of whatever it returns
+            success = self.stream.grab()
+            if success and not self.frame_requested: continue
+            if success: success, frame = self.stream.retrieve(self.buffers[self.write_index])
+            
+            if not success:
+                if not failing: log.warning("Failed to retrieve current frame from camera")
+                failing = True
+                time.sleep(0.2) # Don't keep retrying constantly if the camera has stopped working
+                continue
+                
+            if failing: log.info("Camera frames are being retrieved again")
+            failing = False
+            
+            with self.lock:
+                self.buffers[self.write_index] = frame
+                self.write_index, self.latest_index = self.latest_index, self.write_index
+                self.new_frame = True
+                self.frame_requested = False
+                self.frame_ready.notify()
+                
+        log.debug("Frame grab thread stopping")
+
+class FFmpegWriter():
+    """
+    Writes video frames to an XVID file by piping them to an ffmpeg process to be encoded. This has the same methods as
+    cv2.VideoWriter (or at least the ones we use) so the two can be used interchangeably.
+    """
+    
+    def __init__(self, filename, framerate, resolution):
+        """
+        Starts a new ffmpeg process writing to the given file. If ffmpeg isn't installed, isOpened() will return False.
+        """
+        try:
+            # The large buffer means frames get sent to ffmpeg in a few big writes rather than lots of small ones
+            self.process = subprocess.Popen(["ffmpeg", "-y", "-loglevel", "error",
+                                             "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{resolution[0]}x{resolution[1]}",
+                                             "-r", str(framerate), "-i", "-", "-c:v", "mpeg4", "-vtag", "XVID",
+                                             "-threads", str(ENCODER_THREADS), filename],
+                                            stdin = subprocess.PIPE, bufsize = FFMPEG_BUFFER_SIZE)
+        except FileNotFoundError:
+            self.process = None
+            
+    def isOpened(self):
+        """
+        Returns True if the ffmpeg process is running, False if not.
+        """
+        return self.process is not None and self.process.poll() is None
+        
+    def write(self, frame):
+        """
+        Sends the given frame to ffmpeg to be encoded.
+        """
+        try:
+            # Writing the array's memory directly avoids making a bytes copy of the frame like frame.tobytes() would
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            log.error("ffmpeg stopped unexpectedly, frame could not be written")
+        
+    def release(self):
+        """
+        Finishes writing any buffered frames, then waits for ffmpeg to finish encoding and close the file.
+        """
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass # Nothing we can do about it now, it will have already been logged in write()
+        self.process.wait()
+
+class DisplayThread():
+    """
+    Shows frames in the preview window from a separate thread, so that a slow display can't hold up the capture. All the
+    OpenCV window functions are called from this thread, since they aren't safe to use from more than one thread.
+    """
+    
+    def __init__(self):
+        """
+        Creates the preview window and starts the display thread.
+        """
+        self.thread = Thread(target = self.run, args = (), name = "Display-thread", daemon = True)
+        self.latest = INACTIVE_SCREEN # Only ever rebound, never modified, so it doesn't need a lock
+        self.frame_ready = Event()
+        self.frame_ready.set() # Show the inactive screen straight away
+        self.stop_flag = False
+        self.thread.start()
+        
+    def show(self, frame):
+        """
+        Hands the given frame over to be displayed. If the display thread is still busy with the last one, this replaces it
+        so the preview always shows the latest frame rather than falling behind.
+        """
+        self.latest = frame
+        self.frame_ready.set()
+        
+    def stop(self):
+        """
+        Closes the preview window and waits for the display thread to finish.
+        """
+        self.stop_flag = True
+        self.frame_ready.set()
+        self.thread.join()
+        
+    def run(self):
+        
+        log.debug("Display thread started")
+        
+        cv2.namedWindow(WINDOW_TITLE)
+        
+        while not self.stop_flag:
+            
+            t = time.perf_counter()
+            
+            # Wait for a new frame, but not forever, since the window still needs updating so it doesn't stop responding
+            if self.frame_ready.wait(timeout = 1.0 / PREVIEW_FRAMERATE):
+                self.frame_ready.clear()
+                cv2.imshow(WINDOW_TITLE, self.latest)
+                
+            cv2.waitKey(1) # Required to get opencv to update the window
+            
+            # Limit the preview framerate so it doesn't take processing power away from everything else
+            time.sleep(max(0, 1.0 / PREVIEW_FRAMERATE - (time.perf_counter() - t)))
+            
+        cv2.destroyAllWindows()
+        cv2.waitKey(1) # Required to get opencv to update
+        
+        log.debug("Display thread stopping")
+
 class CaptureWriter():
     """
     Controls the video saving process and video write thread.
@@ -102,21 +446,75 @@ class CaptureWriter():
         self.shutdown_flag = False
         self.frame_buffer = frame_buffer
         self.writer = None
-        self.close_flag = False
+        # Opening and closing files is left to the write thread, so these are queued up in order along with the number of
+        # frames that had been stored at the time, so that each frame always ends up in the file that was open when it
+        # was stored, however far behind the write thread is
+        self.commands = deque()
+        self.frames_stored = 0 # Total number of frames added to the buffer (only ever changed by the main thread)
+        self.frames_popped = 0 # Total number of frames taken out of the buffer (only ever changed by the write thread)
+        self.frames_written = 0
+        self.condition = Condition() # Used to wake the write thread up when there is something for it to do
         self.thread.start()
         
     def new_file(self, save_directory):
         """
         Creates a new video file to write to, with the current date and time as its filename.
         """
-        self.writer = cv2.VideoWriter(f"{save_directory}/captures/{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.avi", codec, settings.FRAMERATE, RESOLUTION)
+        # Creating the video writer opens the file on the USB drive, which can take a while, so we just decide on the
+        # filename here and leave the write thread to actually create it rather than holding up the start of the capture
+        # N.B. No file extension since that depends on which encoder ends up being used (see open_writer())
+        self.queue_command(f"{save_directory}/captures/{datetime.now().strftime('%Y-%m-%d_%H%M%S')}")
+        
+    def open_writer(self, filename):
+        """
+        Creates the underlying video writer for the given filename (without extension). This tries to use the hardware H.264
+        encoder first, and falls back to XVID encoding on the CPU if that isn't available - using ffmpeg if it is installed,
+        otherwise OpenCV's own writer.
+        """
+        writer = cv2.VideoWriter(H264_PIPELINE.format(f"{filename}.mkv"), cv2.CAP_GSTREAMER, 0, settings.FRAMERATE, RESOLUTION, True)
+        
+        if writer.isOpened():
+            log.debug("Opened video file %s.mkv (hardware H.264)", filename)
+            return writer
+        
+        writer = FFmpegWriter(f"{filename}.avi", settings.FRAMERATE, RESOLUTION)
+        
+        if writer.isOpened():
+            log.debug("Unable to use hardware H.264 encoder, opened video file %s.avi (XVID via ffmpeg) instead", filename)
+        else:
+            log.debug("Unable to use hardware H.264 encoder or ffmpeg, opening video file %s.avi (XVID) instead", filename)
+            writer = cv2.VideoWriter(f"{filename}.avi", cv2.CAP_FFMPEG, codec, settings.FRAMERATE, RESOLUTION)
+            
+        return writer
         
     def close_file(self):
         """
         Closes the video file once all buffered frames have been written.
         """
         log.debug("Marking current writer file for closing")
-        self.close_flag = True
+        self.queue_command(None)
+        
+    def queue_command(self, filename):
+        """
+        Queues up a new file to be opened, or the current file to be closed if the filename is None, once all the frames
+        stored so far have been written.
+        """
+        self.commands.append((self.frames_stored, filename))
+        self.wake()
+        
+    def frame_stored(self):
+        """
+        Called when a new frame has been added to the buffer, so that it can be written to the current file.
+        """
+        self.frames_stored += 1
+        self.wake()
+        
+    def wake(self):
+        """
+        Wakes the write thread up if it is waiting, e.g. because a new frame has been added to the buffer.
+        """
+        with self.condition:
+            self.condition.notify()
         
     def shutdown(self):
         """
@@ -124,24 +522,58 @@ class CaptureWriter():
         """
         log.info("Marking video writer for shutdown")
         self.shutdown_flag = True
+        self.wake()
         self.thread.join()
         
+    def close_writer(self):
+        """
+        Closes the current video file, if there is one.
+        """
+        if self.writer is None: return
+        log.info("Closing video file (%i frames written)", self.frames_written)
+        self.frames_written = 0
+        # The muxer only finishes the file properly if the writer is released, so don't leave it to the garbage collector
+        self.writer.release()
+        self.writer = None
+        
+    def has_work(self):
+        """
+        Returns True if the write thread has something to do, False if not.
+        """
+        return bool(self.commands) or not self.frame_buffer.is_empty() or self.shutdown_flag
+        
     def run(self):
         
         log.debug("Video write thread started")
         
-        while not self.shutdown_flag:
+        while True:
             
-            while not self.frame_buffer.is_empty() and self.writer is not None:
-                self.writer.write(self.frame_buffer.pop())
+            # Open or close files once all the frames stored before that was requested have been written
+            # N.B. This has to check for at least that many rather than exactly that many, otherwise if more frames had
+            # somehow already been popped the command would never run and the thread would be stuck forever
+            if self.commands and self.commands[0][0] <= self.frames_popped:
+                _, filename = self.commands.popleft()
+                self.close_writer() # Also done when opening a file, in case the last one was never closed
+                if filename is not None: self.writer = self.open_writer(filename)
+                continue
             
-            if self.close_flag:
-                log.info("Closing video file")
-                self.writer = None # Allow the garbage collector to release the writer resources itself
-                self.close_flag = False
+            if not self.frame_buffer.is_empty():
+                frame = self.frame_buffer.pop()
+                self.frames_popped += 1
+                if self.writer is not None:
+                    self.writer.write(frame)
+                    self.frames_written += 1 # Logged when the file is closed rather than logging every frame
+                continue
                 
-            time.sleep(0.2) # Save processing power when not doing anything
+            # Only check this once everything else is done, so that any remaining frames always get written before stopping
+            if self.shutdown_flag and not self.commands: break
+                
+            # Save processing power by waiting until there's something to do
+            # The timeout is just a safety net, everything that gives the thread work to do should call wake()
+            with self.condition:
+                if not self.has_work(): self.condition.wait(timeout = 1.0)
             
+        self.close_writer() # Should already have been done by close_file(), but make sure the file gets finished properly
         log.debug("Video write thread stopping")
 
 ### Setup ###
@@ -149,21 +581,44 @@ class CaptureWriter():
 log.info("Initialising camera")
 
 # Initialise module variables
-raw_frame = INACTIVE_SCREEN
-annotated_frame = INACTIVE_SCREEN
+# These are copies so that anything writing into them in-place can't accidentally draw over the inactive screen
+raw_frame = INACTIVE_SCREEN.copy()
+
+# Frames are annotated straight into the frame buffer (see annotate_current()), this is only used when it's full
+spare_frame = INACTIVE_SCREEN.copy()
+annotated_frame = spare_frame
 
-# Initialise camera object
+# Initialise camera object and the frame grabber that reads from it
 stream = cv2.VideoCapture()
+grabber = FrameGrabber(stream)
+
+# The camera is mounted upside-down, so ask the camera driver to rotate the image for us if possible since that saves us
+# from having to rotate every frame ourselves (the pi camera driver supports this but other cameras might not)
+try:
+    hardware_rotation = subprocess.run(["v4l2-ctl", "-d", f"/dev/video{CAMERA_INDEX}", "--set-ctrl=rotate=180"],
+                                       stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode == 0
+except FileNotFoundError:
+    hardware_rotation = False # v4l-utils isn't installed
+    
+if not hardware_rotation: log.warning("Unable to set camera rotation, frames will be rotated in software instead")
 
-# Open preview window
-cv2.namedWindow(WINDOW_TITLE)
-cv2.imshow(WINDOW_TITLE, INACTIVE_SCREEN)
+# Open preview window (there's nothing to display it on outside of dev mode)
+display = DisplayThread() if settings.DEV_MODE else None
 
 # Initialise video writer codec
 codec = cv2.VideoWriter_fourcc(*"XVID")
 
+# OpenCV's ffmpeg video writer only uses one thread by default, this makes it spread encoding over all the cores instead
+# (unless something else has been set already)
+# N.B. OpenCV only reads this from versions 3.4.14 and 4.5.2 onwards, so it does nothing with the 3.4.6 on the pi - there,
+# multithreaded CPU encoding comes from FFmpegWriter instead, which passes the thread count to ffmpeg itself
+os.environ.setdefault("OPENCV_FFMPEG_WRITER_OPTIONS", f"threads;{ENCODER_THREADS}")
+
 # Stores the captured frames to be written to disk later
-frame_buffer = FrameBuffer(settings.FRAME_BUFFER_SIZE, WIDTH, HEIGHT)
+if settings.BUFFER_JPEG_QUALITY > 0:
+    frame_buffer = CompressedFrameBuffer(settings.FRAME_BUFFER_SIZE, WIDTH, HEIGHT, settings.BUFFER_JPEG_QUALITY)
+else:
+    frame_buffer = FrameBuffer(settings.FRAME_BUFFER_SIZE, WIDTH, HEIGHT)
 
 # Initialise writer thread
 writer = CaptureWriter(frame_buffer)
@@ -171,6 +626,26 @@ writer = CaptureWriter(frame_buffer)
 # Stores objects detected this capture, for logging purposes
 detected_objects = []
 
+# Set while the camera is open and has delivered its first frame, so other threads can wait for capturing to start rather
+# than repeatedly checking
+capturing = Event()
+
+# Caches a pre-rendered image of each label, since the same labels come up over and over again and drawing text is slow
+label_tiles = {}
+
+# The detections only change when the object detector finishes a cycle, which is much less often than every frame, so the
+# boxes and labels to draw are only worked out when they change (see get_overlay())
+overlay_source = None # The boxes array the current overlay was worked out from
+overlay = None
+
+# The date and time text only changes once a second, so there's no point formatting it every frame
+timestamp_second = 0
+timestamp_text = ""
+
+# Whether to ask the camera for raw YUYV frames (see open()) - this gets turned off if the installed version of OpenCV
+# doesn't return them in a format capture_frame() can use
+raw_yuyv = settings.HISTOGRAM_EQUALISATION
+
 ### Functions ###
 
 def is_capturing():
@@ -179,67 +654,221 @@ def is_capturing():
     """
     return stream.isOpened()
 
+def wait_for_capture(timeout):
+    """
+    Waits until the camera stream is open and has delivered its first frame, or until the timeout runs out.
+    
+    Parameters:
+    - timeout: Maximum time in seconds to wait
+    
+    Returns:
+    - True if the camera is capturing, False if the timeout ran out first
+    """
+    return capturing.wait(timeout)
+
 def open(save_directory):
     """
     Opens the camera stream.
     """
     log.info("Opening camera stream")
-    global stream
-    global writer
-    stream.open(CAMERA_INDEX)
+    
+    global raw_yuyv
+    
+    # Pass the camera settings in when opening the stream so the driver can set the camera up in one go, rather than
+    # reconfiguring it for each setting in turn
+    params = [cv2.CAP_PROP_FRAME_WIDTH, WIDTH, cv2.CAP_PROP_FRAME_HEIGHT, HEIGHT]
     # For some reason this introduces a delay when capturing the frame, it seems to work okay without it though
-    #stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
-    stream.set(3, WIDTH)
-    stream.set(4, HEIGHT)
+    #params += [cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG')]
+    if raw_yuyv:
+        # Get the frames as raw YUYV instead of having OpenCV convert them to BGR, since capture_frame() needs the luma
+        # channel anyway and can then do a single conversion to BGR once it's finished with it
+        params += [cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'YUYV'), cv2.CAP_PROP_CONVERT_RGB, 0]
+        
+    try:
+        stream.open(CAMERA_INDEX, cv2.CAP_V4L2, params)
+    except (TypeError, cv2.error):
+        # Versions of OpenCV before 4.5 can't take the parameters when opening, so set them one at a time instead
+        stream.open(CAMERA_INDEX, cv2.CAP_V4L2)
+        for prop, value in zip(params[::2], params[1::2]):
+            stream.set(prop, value)
+    
+    # Some versions of OpenCV (including 3.4 on the pi) return unconverted frames as a single-channel buffer of raw bytes
+    # rather than a 2-channel YUYV image, so check the first frame and have OpenCV convert to BGR after all if necessary
+    if raw_yuyv:
+        success, frame = stream.read()
+        if success and not (frame.ndim == 3 and frame.shape[2] == 2):
+            log.warning("Raw YUYV frames from this version of OpenCV have shape %s, using BGR frames instead", frame.shape)
+            stream.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+            raw_yuyv = False # Don't bother asking for them next time
+            
+    grabber.start()
     writer.new_file(save_directory)
     
+    # Wait for the first frame so that the object detector and the new video never see a frame from before the camera
+    # was opened (see close())
+    if not capture_frame(FIRST_FRAME_TIMEOUT):
+        log.warning("Camera did not deliver a frame within %d seconds of opening", FIRST_FRAME_TIMEOUT)
+    
+    capturing.set()
+    
 def close():
     """
     Closes the camera stream, finishes saving the video and releases the resources it was using.
     """
     log.info("Closing camera stream")
-    global stream
+    capturing.clear() # Do this first so the object detector stops using the frames as soon as possible
+    grabber.stop()
     stream.release()
-    
-    global writer
     writer.close_file()
     
+    # Clear the last frame, otherwise it would be used again when the camera is next opened, which could be hours later
+    global raw_frame
+    raw_frame = INACTIVE_SCREEN.copy()
+    
     global detected_objects
+    global overlay_source
     detected_objects = []
+    overlay_source = None # So that the next capture logs its detected objects again
     
 def shutdown():
     """
     Closes the camera, releases the resources it was using, saves any frames in the buffer and closes any open windows.
     """
     log.info("Closing open windows")
-    cv2.destroyAllWindows()
+    if display is not None: display.stop()
     close()
-    cv2.waitKey(1) # Required to get opencv to update
-    global writer
     writer.shutdown() # Wait for video writer to shut down
 
-def capture_frame():
+def capture_frame(timeout = 0):
     """
-    Captures the next frame from the camera.
+    Updates the raw frame with the latest frame from the camera, if there is a new one.
+    
+    Parameters:
+    - timeout: Maximum time in seconds to wait for a new frame if there isn't one already (by default this doesn't wait)
+    
+    Returns:
+    - True if the raw frame was updated, False if there was no new frame
     """
-    global stream
     global raw_frame
     
-    success, raw_frame = stream.read()
-    raw_frame = cv2.rotate(raw_frame, cv2.ROTATE_180)
+    # The frame grabber thread does the actual reading from the camera, so this doesn't need to wait for the next frame
+    captured = grabber.get_latest(timeout)
+    if captured is None: return False # No new frame since last time, so just keep the current one
     
-    if settings.HISTOGRAM_EQUALISATION:
-        # Convert to YUV colour space
-        yuv = cv2.cvtColor(raw_frame, cv2.COLOR_BGR2YUV)
-        # Flatten pixels with lowest y-channel, i.e. luma/brightness to make the darkest areas uniform before equalising
-        yuv[:, :, 0][yuv[:, :, 0] < settings.LUMA_THRESHOLD] = 0
-        # Perform histogram equalisation on luma channel to improve image contrast
-        yuv[:, :, 0] = cv2.equalizeHist(yuv[:, :, 0])
-        # Convert back to BGR colour space
-        raw_frame = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR)
+    yuyv = captured.ndim == 3 and captured.shape[2] == 2 # Raw YUYV frame (see open())
+    
+    # Anything else that isn't a normal 3-channel BGR frame can't be processed, so skip it rather than crashing
+    if not yuyv and (captured.ndim != 3 or captured.shape[2] != 3):
+        log.debug("Ignoring camera frame with unexpected shape %s", captured.shape)
+        return False
+    
+    # On platforms with OpenCL (not the pi, but it is useful on a desktop in dev mode), OpenCV can do all the processing
+    # below on the GPU if we give it a UMat instead of a numpy array
+    frame = cv2.UMat(captured) if USE_OPENCL else captured
+    
+    if yuyv:
+        # The first channel of a YUYV frame is luma and the second alternates between the U and V values of each pair of
+        # pixels - histogram equalisation only needs the luma channel, so we can do it on the frame as-is rather than
+        # converting to BGR, then to YUV and back again
+        if settings.HISTOGRAM_EQUALISATION: frame = equalise_luma(frame)
+        frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV)
         
-    if not success:
-        log.warning("Failed to retrieve current frame from camera")
+    elif settings.HISTOGRAM_EQUALISATION:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV) # Convert to YUV colour space
+        frame = equalise_luma(frame)
+        frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR) # Convert back to BGR colour space
+    
+    if USE_OPENCL: frame = frame.get() # Everything else needs a numpy array
+    
+    # Rotating by 180 degrees is the same as reversing both axes, which numpy can do as a view without copying anything
+    if not hardware_rotation: frame = frame[::-1, ::-1]
+    
+    # N.B. The raw frame must never share memory with the captured frame, because the object detector thread may still be
+    # using it when a later frame gets grabbed into the same buffer
+    if np.may_share_memory(frame, captured): frame = frame.copy()
+    
+    # The raw frame is always replaced with a new array rather than overwritten, and nothing ever modifies it, so the
+    # object detector thread can use it directly without taking a copy first
+    raw_frame = frame
+    return True
+
+def equalise_luma(frame):
+    """
+    Performs histogram equalisation on the luma channel (channel 0) of the given YUV or YUYV frame to improve the image
+    contrast. This only uses OpenCV functions so that the frame can be either a numpy array or a UMat.
+    
+    Returns:
+    - The equalised frame, which may or may not be the same object as the one passed in
+    """
+    luma = cv2.extractChannel(frame, 0)
+    # Flatten pixels with lowest y-channel, i.e. luma/brightness to make the darkest areas uniform before equalising
+    # THRESH_TOZERO sets everything that isn't above the threshold to zero, hence the -1
+    _, luma = cv2.threshold(luma, settings.LUMA_THRESHOLD - 1, 255, cv2.THRESH_TOZERO)
+    # Perform histogram equalisation on luma channel to improve image contrast
+    luma = cv2.equalizeHist(luma)
+    return cv2.insertChannel(luma, frame, 0)
+
+def get_label_tile(label):
+    """
+    Returns an image of the given label text in a white box, along with the height of the text (excluding the baseline),
+    rendering it first if it isn't already cached.
+    """
+    if label not in label_tiles:
+        labelSize, baseLine = cv2.getTextSize(label, FONT, 0.7, 2) # Get font size
+        tile = np.full((labelSize[1] + baseLine, labelSize[0], 3), LABEL_COLOUR, dtype = "uint8") # Box to put label text in
+        cv2.putText(tile, label, (0, labelSize[1] + 3), FONT, 0.7, LABEL_TEXT_COLOUR, 2) # Draw label text
+        label_tiles[label] = (tile, labelSize[1])
+    return label_tiles[label]
+
+def get_overlay(boxes, labels, scores):
+    """
+    Works out where to draw the given detection boxes and labels, reusing the last result if they are the same detections
+    as last time.
+    
+    Returns:
+    - A list of the contours to draw for the detection boxes
+    - A list of (label image, y, x) tuples for each label, already cut off at the right-hand edge of the frame if necessary
+    """
+    global overlay_source
+    global overlay
+    if boxes is overlay_source: return overlay # Same detection cycle as last time
+    
+    # Only keep detections with a valid confidence above the minimum threshold
+    # The object detector should have already removed any below the threshold, but the interpreter can occasionally return
+    # scores greater than 1, so it doesn't hurt to check again - and it's all done in one go so it costs next to nothing
+    scores_array = np.asarray(scores, dtype = np.float32)
+    keep = np.flatnonzero((scores_array > settings.CONFIDENCE_THRESHOLD) & (scores_array <= 1.0))
+    scores_array = scores_array[keep]
+    labels_array = np.asarray(labels)[keep]
+    
+    # Get bounding box coordinates for all detections in one go
+    # Interpreter can return coordinates that are outside of image dimensions, need to force them to be within image by clipping
+    # The reshape makes sure we still get an (n, 4) array when there are no detections (boxes starts off as an empty list)
+    box_coords = np.clip(np.asarray(boxes, dtype = np.float32).reshape(-1, 4)[keep] * BOX_SCALE, 1, BOX_SCALE).astype(np.int32)
+    
+    # The detection boxes are all drawn with a single OpenCV call rather than one cv2.rectangle call per box
+    # Each box becomes a contour made of its 4 corners in (x, y) order: top-left, top-right, bottom-right, bottom-left
+    box_contours = list(box_coords[:, [1, 0, 3, 0, 3, 2, 1, 2]].reshape(-1, 4, 1, 2))
+    
+    # Work out the labels separately since the text is different for each
+    tiles = []
+    for i in range(len(scores_array)):
+
+        ymin, xmin = box_coords[i, :2].tolist() # Convert to Python ints for slicing
+
+        object_name = labels_array[i] # Look up object name from "labels" array using class index
+        label = '%s: %d%%' % (object_name, int(scores_array[i]*100)) # Example: 'person: 72%'
+        tile, text_height = get_label_tile(label)
+        # Make sure not to draw the label too close to the top of the window, and cut it off if it goes over the right-hand edge
+        tiles.append((tile[:, :WIDTH - xmin], max(ymin - text_height - 10, 0), xmin))
+
+        if object_name not in detected_objects:
+            log.info("Detected %s", object_name)
+            detected_objects.append(object_name)
+            
+    overlay_source = boxes
+    overlay = (box_contours, tiles)
+    return overlay
 
 def annotate_current(boxes, labels, scores, fps, buzzer_active):
     """
@@ -251,48 +880,46 @@ def annotate_current(boxes, labels, scores, fps, buzzer_active):
     # Take a copy of the raw frame
     # We need to take care not to modify the raw frame because we can't guarantee when the object detector thread will
     # access it, and we don't want it performing object detection on the annotated frame
+    # Rather than a new array, the copy goes straight into the next slot in the frame buffer so it doesn't need copying
+    # again when it gets stored - if the buffer is full it won't be stored anyway, but it still needs annotating for display
+    # N.B. Everything below works on a local reference, since those are quicker to look up than globals
     global annotated_frame
-    annotated_frame = raw_frame.copy()
+    frame = frame_buffer.get_write_slot()
+    if frame is None: frame = spare_frame
+    np.copyto(frame, raw_frame)
+    annotated_frame = frame
     
-    # Loop over all detections and draw detection box if confidence is above minimum threshold
-    for i in range(len(scores)):
-
-        # Get bounding box coordinates and draw box
-        # Interpreter can return coordinates that are outside of image dimensions, need to force them to be within image using max() and min()
-        ymin = int(max(1,(boxes[i][0] * HEIGHT)))
-        xmin = int(max(1,(boxes[i][1] * WIDTH)))
-        ymax = int(min(HEIGHT,(boxes[i][2] * HEIGHT)))
-        xmax = int(min(WIDTH,(boxes[i][3] * WIDTH)))
-        
-        cv2.rectangle(annotated_frame, (xmin, ymin), (xmax, ymax), (10, 255, 0), 2)
-
-        # Draw label
-        object_name = labels[i] # Look up object name from "labels" array using class index
-        label = '%s: %d%%' % (object_name, int(scores[i]*100)) # Example: 'person: 72%'
-        labelSize, baseLine = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2) # Get font size
-        label_ymin = max(ymin, labelSize[1] + 10) # Make sure not to draw label too close to top of window
-        cv2.rectangle(annotated_frame, (xmin, label_ymin-labelSize[1]-10), (xmin+labelSize[0], label_ymin+baseLine-10), (255, 255, 255), cv2.FILLED) # Draw white box to put label text in
-        cv2.putText(annotated_frame, label, (xmin, label_ymin-7), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2) # Draw label text
-
-        global detected_objects
-        if object_name not in detected_objects:
-            log.info("Detected %s", object_name)
-            detected_objects.append(object_name)
+    # Draw the detection boxes and labels
+    box_contours, tiles = get_overlay(boxes, labels, scores)
+    if box_contours: cv2.drawContours(frame, box_contours, -1, BOX_COLOUR, 2)
+    for tile, y, x in tiles:
+        frame[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
 
     # Date and time
-    cv2.putText(annotated_frame, f"{datetime.now().strftime('%d-%m-%Y %I:%M:%S %p')}   {fps} fps   Buzzer {'active' if buzzer_active else 'inactive'}", (10, HEIGHT - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, TEXT_COLOUR, 1, cv2.LINE_AA)
+    global timestamp_second
+    global timestamp_text
+    now = time.time()
+    if int(now) != timestamp_second:
+        timestamp_second = int(now)
+        timestamp_text = datetime.fromtimestamp(now).strftime('%d-%m-%Y %I:%M:%S %p')
+        
+    cv2.putText(frame, f"{timestamp_text}   {fps} fps   Buzzer {'active' if buzzer_active else 'inactive'}", (10, HEIGHT - 10), FONT, 0.5, TEXT_COLOUR, 1, LINE_AA)
 
 def display_current():
     """
-    Displays the current frame with annotations
+    Displays the current frame with annotations. This does nothing outside of dev mode.
+    
+    N.B. This only hands the frame over to the display thread, which updates the window at its own pace (see DisplayThread)
     """
-    global annotated_frame
-    cv2.imshow(WINDOW_TITLE, annotated_frame)
+    if display is None: return
+    display.show(annotated_frame)
     
 def store_current():
     """
     Stores the current frame to the buffer and returns True if successful
     """
-    global annotated_frame
-    global frame_buffer
-    return frame_buffer.push(annotated_frame)
\ No newline at end of file
+    if annotated_frame is spare_frame: return False # Buffer was already full when the frame was annotated
+    # The annotated frame is already in the next slot of the buffer, so it just needs adding to the queue
+    if not frame_buffer.commit(): return False
+    writer.frame_stored() # Let the writer know there's a new frame to write
+    return True
\ No newline at end of file
@@ -21,8 +21,17 @@ BUZZER_PIN       = 4
 IR_LED_PIN_1     = 23
 IR_LED_PIN_2     = 24
 
+# Bit masks for setting several pins at once with pigpio's bank functions, which only takes one call to the pigpio daemon
+# rather than one per pin, and also means the pins all switch at exactly the same time
+IR_LED_MASK     = (1 << IR_LED_PIN_1) | (1 << IR_LED_PIN_2)
+PIR_ENABLE_MASK = 1 << PIR_ENABLE_PIN
+
 REFRESH_RATE = 20 # Number of times per second to update the gpio outputs
 
+# Whether debug messages are being logged; checked before logging from functions that get called a lot, so the message
+# arguments aren't worked out for nothing (the log level is set by the settings module, which is always imported first)
+DEBUG_LOGGING = log.getLogger().isEnabledFor(log.DEBUG)
+
 ### Setup ###
 
 # Initialise module variables
@@ -56,7 +65,7 @@ def get_pir_state():
     disabled.
     """
     result = pi.read(PIR_SENSOR_PIN)
-    log.debug("Read PIR pin (GPIO %i), level is %s", PIR_SENSOR_PIN, "HIGH" if result else "LOW")
+    if DEBUG_LOGGING: log.debug("Read PIR pin (GPIO %i), level is %s", PIR_SENSOR_PIN, "HIGH" if result else "LOW")
     return result
 
 def enable_pir_sensor(enable):
@@ -66,7 +75,7 @@ def enable_pir_sensor(enable):
     Parameters:
     - enable: True to enable the PIR sensor, False to disable it.
     """
-    log.debug("Setting PIR enable pin (GPIO %i) to output %s", PIR_ENABLE_PIN, "HIGH" if enable else "LOW")
+    if DEBUG_LOGGING: log.debug("Setting PIR enable pin (GPIO %i) to output %s", PIR_ENABLE_PIN, "HIGH" if enable else "LOW")
     pi.write(PIR_ENABLE_PIN, enable)
 
 def set_power_led_state(state):
@@ -76,7 +85,7 @@ def set_power_led_state(state):
     Parameters:
     - state: True to turn the LED on, False to turn it off.
     """
-    log.debug("Setting LED pin (GPIO %i) to output %s", POWER_LED_PIN, "HIGH" if state else "LOW")
+    if DEBUG_LOGGING: log.debug("Setting LED pin (GPIO %i) to output %s", POWER_LED_PIN, "HIGH" if state else "LOW")
     pi.write(POWER_LED_PIN, state)
     
 def set_ir_led_state(state):
@@ -87,9 +96,11 @@ def set_ir_led_state(state):
     Parameters:
     - state: True to turn the IR LEDs on, False to turn them off.
     """
-    log.debug("Setting IR LED pins (GPIO %i & %i) to output %s", IR_LED_PIN_1, IR_LED_PIN_2, "HIGH" if state else "LOW")
-    pi.write(IR_LED_PIN_1, state)
-    pi.write(IR_LED_PIN_2, state)
+    if DEBUG_LOGGING: log.debug("Setting IR LED pins (GPIO %i & %i) to output %s", IR_LED_PIN_1, IR_LED_PIN_2, "HIGH" if state else "LOW")
+    if state:
+        pi.set_bank_1(IR_LED_MASK)
+    else:
+        pi.clear_bank_1(IR_LED_MASK)
     
 def set_buzzer_frequency(frequency):
     """
@@ -109,11 +120,13 @@ def prepare_shutdown():
     global btn_callback
     global pi
     
-    # For now we need to turn this off for shutdown or it will stay on, at some point I may look into ways of turning it
+    # The IR LEDs and the PIR sensor are turned off together, in a single call
+    # For now we need to turn the PIR off for shutdown or it will stay on, at some point I may look into ways of turning it
     # off later on in the shutdown sequence but it doesn't really matter that much - the main thing is that it stays on
-    # while the video is saving
-    if not settings.DEV_MODE: enable_pir_sensor(False) # Keep PIR on in dev mode so we don't always have to wait for warm-up
-    set_ir_led_state(False)
+    # while the video is saving (keep it on in dev mode though, so we don't always have to wait for warm-up)
+    off_mask = IR_LED_MASK if settings.DEV_MODE else IR_LED_MASK | PIR_ENABLE_MASK
+    if DEBUG_LOGGING: log.debug("Setting output pins (bank mask %#010x) to output LOW", off_mask)
+    pi.clear_bank_1(off_mask)
     set_buzzer_frequency(0)
     
     pir_callback.cancel()
@@ -155,14 +168,14 @@ def init_btn_callback(func):
     btn_callback = pi.callback(POWER_BUTTON_PIN, gpio.EITHER_EDGE, btn_pin_callback)
 
 def pir_pin_callback(pin, level, tick):
-    log.debug("PIR sensor callback triggered (GPIO %i)", pin)
+    if DEBUG_LOGGING: log.debug("PIR sensor callback triggered (GPIO %i)", pin)
     if level != 1:
         log.warn("Unexpected callback value on GPIO %i: %i (probably a timeout)", pin, level)
         return # Sanity check: ignore if it wasn't a rising edge (only happens on timeout)
     pir_cb_forward() # Pass control flow up to the main lookout class
     
 def btn_pin_callback(pin, level, tick):
-    log.debug("Power button callback triggered (GPIO %i)", pin)
+    if DEBUG_LOGGING: log.debug("Power button callback triggered (GPIO %i)", pin)
     if level > 1:
         log.warn("Unexpected callback value on GPIO %i: %i (probably a timeout)", pin, level)
         return # Sanity check: ignore if it wasn't a rising edge (only happens on timeout)
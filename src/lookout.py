@@ -14,13 +14,15 @@ import time                    # Timing functions
 from datetime import datetime  # Real-world date and time
 import logging as log          # Log messages and log file output
 from enum import Enum          # Enumeration types
-import cv2                     # OpenCV for image processing
 import threading               # Concurrency
 import signal                  # System exit signals
 
 ### Constants ###
 
 FORCE_SHUTDOWN_TIME = 5 # If the power button is held for longer than this many seconds, it forces a shutdown
+LED_FLASH_INTERVAL = 2  # Time in seconds between flashes of the power LED while capturing
+LED_FLASH_TIME = 0.1    # Length of each flash of the power LED in seconds
+SLEEP_MARGIN = 0.001    # time.sleep() can overshoot by about this many seconds, so the end of each frame is waited out exactly
 
 # N.B. Because we're using a callback approach here, we can't just have a shutdown method, we also need a way of
 # preventing any callbacks from executing. The only way of doing this is to have the callback exit early when the state
@@ -38,6 +40,7 @@ state = State.INACTIVE
 idle_timer = 0
 buzzer_timer = 0
 btn_hold_timer = 0
+state_changed = threading.Event() # Set whenever the state changes, so the main loop can wait for it rather than polling
 
 # Initialise other modules
 import settings
@@ -47,9 +50,9 @@ gpio.enable_pir_sensor(True)
 import camera_manager as camera
 import object_detector
 
-if settings.DEV_MODE:
-    camera.display_current() # Show blank screen
-    cv2.waitKey(2) # For some reason it needs 2ms
+# Sets of objects that trigger and disarm the buzzer, which are much quicker to check the detected objects against than lists
+blacklist = frozenset(settings.OBJECT_BLACKLIST)
+whitelist = frozenset(settings.OBJECT_WHITELIST)
 
 ### Functions ###
 
@@ -60,6 +63,7 @@ def on_pir_activated():
     log.info("PIR sensor activated")
     global state
     state = State.ACTIVE
+    state_changed.set()
     
 def on_power_btn_pressed(released):
     """
@@ -76,6 +80,7 @@ def on_power_btn_pressed(released):
             if settings.DEV_MODE:
                 os.kill(os.getpid(), signal.SIGINT) # sys.exit() won't work here
             else:
+                settings.flush_log()
                 os.system("sudo shutdown -h now")
             
         else:
@@ -84,6 +89,7 @@ def on_power_btn_pressed(released):
             
             global state
             state = State.SHUTTING_DOWN
+            state_changed.set()
             
             gpio.set_power_led_state(True)
         
@@ -102,30 +108,48 @@ def capture_video():
     global idle_timer
     global buzzer_timer
 
-    i = 0
+    start = time.perf_counter()
+    led_timer = start # Time of the last power LED flash
+    led_on = False
     measured_framerate = 0
+    framerate_timer = start # Start of the current framerate measurement
+    frame_count = 0 # Number of frames since the start of the current framerate measurement
+    frame_period = 1.0/settings.FRAMERATE # Target time per frame in seconds, worked out once here rather than every frame
+    frame_deadline = start # Time at which the next frame is due
     
     while True: # Capture until one of the return statements below is reached
         
+        # All the timers below use this one timestamp, so they're consistent with each other and the clock only needs
+        # reading once per frame (apart from the end of frame wait, which needs the actual time)
         t = time.perf_counter()
         
+        # Work out when the frame after this one is due from when this one was due rather than when it actually started,
+        # so that small delays don't add up and slow the framerate down - unless we're already a whole frame behind, in
+        # which case there's no point trying to catch up
+        frame_deadline = max(frame_deadline, t - frame_period) + frame_period
+        
+        # Measure the framerate over a whole second rather than every frame, which is less work and makes it less jumpy
+        if t - framerate_timer >= 1:
+            measured_framerate = round(frame_count / (t - framerate_timer), 1)
+            framerate_timer = t
+            frame_count = 0
+        frame_count += 1
+        
         camera.capture_frame()
         
-        boxes = object_detector.boxes
-        labels = object_detector.labels
-        scores = object_detector.scores
+        boxes, labels, scores = object_detector.latest() # Always from the same detection cycle
         
         if len(labels) > 0: # If we found something
     
-            idle_timer = time.perf_counter() # Reset idle timer
+            idle_timer = t # Reset idle timer
             
             # Check objects against blacklist/whitelist
-            if settings.ENABLE_BUZZER and any(item in settings.OBJECT_BLACKLIST for item in labels) and all(item1 not in settings.OBJECT_WHITELIST for item1 in labels):
+            if settings.ENABLE_BUZZER and not blacklist.isdisjoint(labels) and whitelist.isdisjoint(labels):
                 # Activate the buzzer and start the timer
                 if buzzer_timer == 0: gpio.set_buzzer_frequency(settings.BUZZER_FREQUENCY)
-                buzzer_timer = time.perf_counter()
+                buzzer_timer = t
                 
-        if buzzer_timer != 0 and time.perf_counter() - buzzer_timer >= settings.BUZZ_TIME: # If buzzer time has elapsed
+        if buzzer_timer != 0 and t - buzzer_timer >= settings.BUZZ_TIME: # If buzzer time has elapsed
             # Deactivate the buzzer and reset the timer
             gpio.set_buzzer_frequency(0)
             buzzer_timer = 0
@@ -139,25 +163,27 @@ def capture_video():
             log.info("Buffer full, stopping current recording")
             return True
             
-        if time.perf_counter() - idle_timer >= settings.IDLE_TIME: # If idle time has elapsed
+        if t - idle_timer >= settings.IDLE_TIME: # If idle time has elapsed
             return True
         
         if state == State.SHUTTING_DOWN:
             return False
         
-        # LED flashing
-        if i == 20:
+        # LED flashing - this is timed rather than counting frames so it doesn't slow down when the framerate drops, and
+        # the LED is only written to when it actually needs to change
+        if t - led_timer >= LED_FLASH_INTERVAL:
             gpio.set_power_led_state(True)
-            i = 0
-        else:
-            if i == 0:
-                gpio.set_power_led_state(False)
-            i += 1
-        
-        measured_framerate = min(settings.FRAMERATE, round(1/(time.perf_counter() - t), 1))
+            led_timer = t
+            led_on = True
+        elif led_on and t - led_timer >= LED_FLASH_TIME:
+            gpio.set_power_led_state(False)
+            led_on = False
         
         # Try to keep a stable framerate by waiting for the rest of the time, if any
-        cv2.waitKey(max(1, int(1000 * (1.0/settings.FRAMERATE - (time.perf_counter() - t)))))
+        # N.B. This can't use cv2.waitKey() any more since the preview window belongs to the display thread
+        remaining = frame_deadline - time.perf_counter()
+        if remaining > SLEEP_MARGIN: time.sleep(remaining - SLEEP_MARGIN)
+        while time.perf_counter() < frame_deadline: pass # Wait out the last bit exactly
 
 ### Finish Setup ###
 
@@ -174,6 +200,9 @@ log.info("Setup done")
 
 while state != State.SHUTTING_DOWN: # Keep doing this until the program shuts down
     
+    # N.B. This must be cleared before checking the state, otherwise a change in between would be missed
+    state_changed.clear()
+    
     if state == State.ACTIVE:
         
         idle_timer = time.perf_counter() # Start idle timer
@@ -188,8 +217,9 @@ while state != State.SHUTTING_DOWN: # Keep doing this until the program shuts do
             camera.close()
             gpio.set_buzzer_frequency(0)
             gpio.set_ir_led_state(False)
-        
-    time.sleep(0.2) # Save processing power when not doing anything
+            
+    else:
+        state_changed.wait() # Save processing power by sleeping until the PIR sensor or power button is triggered
 
 ### Shutdown ###
 
@@ -207,4 +237,5 @@ log.info("*** Exiting program ***")
 if settings.DEV_MODE:
     sys.exit()
 else:
+    settings.flush_log()
     os.system("poweroff")
\ No newline at end of file
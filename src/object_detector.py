@@ -18,6 +18,7 @@ import time                   # Timing functions
 import cv2                    # OpenCV functions
 import numpy as np            # Matrix operations
 from threading import Thread  # Concurrency
+from collections import namedtuple # Lightweight immutable records
 import importlib.util         # Library for importing TensorFlow stuff
 
 import camera_manager as camera
@@ -27,22 +28,29 @@ import settings
 
 GRAPH_NAME           = "detect.tflite"  # Name of the graph (.tflite) file in the above directory
 LABELMAP_NAME        = "labelmap.txt"   # Name of the label map (.txt) file in the above directory
+XNNPACK_LIBRARY      = "libtensorflowlite_xnnpack_delegate.so" # XNNPACK delegate library, for much faster ARM kernels
+
+# Number of threads TensorFlow uses to run the model - one per core, except for the core left for everything else (see run())
+DETECTION_THREADS = max((os.cpu_count() or 1) - 1, 1)
 
 # Derived values
 PATH_TO_CKPT   = os.path.join(settings.MODEL_NAME, GRAPH_NAME)     # Path to .tflite file
 PATH_TO_LABELS = os.path.join(settings.MODEL_NAME, LABELMAP_NAME)  # Path to label map file
 
+### Classes ###
+
+# The results of a single detection cycle - these are immutable, so a new one is made for each cycle
+Detections = namedtuple("Detections", ["boxes", "labels", "scores"])
+
 ### Setup ###
 
 # Initialise module variables
-boxes = []
-labels = []
-scores = []
+# The results of the latest detection cycle - these are always replaced together in a single assignment so that other
+# threads can never see the boxes from one cycle with the labels from another
+detections = Detections([], [], [])
 
 shutdown_flag = False
 
-log.info("Initialising TensorFlow model")
-
 # Most of this is taken from the example scripts, minus the edge TPU stuff since we're not using that
 
 # Import TensorFlow libraries
@@ -50,9 +58,9 @@ log.info("Initialising TensorFlow model")
 # If using Coral Edge TPU, import the load_delegate library
 pkg = importlib.util.find_spec("tflite_runtime")
 if pkg:
-    from tflite_runtime.interpreter import Interpreter
+    from tflite_runtime.interpreter import Interpreter, load_delegate
 else:
-    from tensorflow.lite.python.interpreter import Interpreter
+    from tensorflow.lite.python.interpreter import Interpreter, load_delegate
 
 # Load the label map
 with open(PATH_TO_LABELS, 'r') as f:
@@ -64,33 +72,108 @@ with open(PATH_TO_LABELS, 'r') as f:
 if label_map[0] == '???':
     del(label_map[0])
 
-# Load the Tensorflow Lite model.
-interpreter = Interpreter(model_path=PATH_TO_CKPT)
-interpreter.allocate_tensors()
+# Array versions of the label map, so the results can be looked up for all the detected objects at once
+label_array = np.array(label_map)
+valid_classes = np.array([label in settings.VALID_OBJECTS for label in label_map]) # Which classes count as valid objects
 
-# Get model details
-input_details = interpreter.get_input_details()
-output_details = interpreter.get_output_details()
-height = input_details[0]['shape'][1]
-width = input_details[0]['shape'][2]
-
-floating_model = (input_details[0]['dtype'] == np.float32)
+# Results to use when nothing is detected, which is most of the time, so the same empty arrays can be reused every time
+NO_DETECTIONS = Detections(np.empty((0, 4), dtype = np.float32), label_array[:0], np.empty(0, dtype = np.float32))
 
 input_mean = 127.5
 input_std = 127.5
 
+# The model itself is loaded by the object detection thread (see load_model())
+interpreter = None
+
+def load_model():
+    """
+    Loads the TensorFlow Lite model and sets up the buffers used to pass frames into it and get the results out. This is
+    called from the object detection thread after it has set its CPU affinity, so that the worker threads TensorFlow starts
+    while loading the model inherit that affinity rather than the main thread's (see run()).
+    """
+    global interpreter
+    global height
+    global width
+    global floating_model
+    global input_tensor
+    global resized_buffer
+    global rgb_buffer
+    global boxes_tensor
+    global classes_tensor
+    global scores_tensor
+    
+    log.info("Initialising TensorFlow model")
+    
+    # Load the Tensorflow Lite model.
+    # The XNNPACK delegate runs the convolutions using kernels optimised for ARM, which is a lot faster than the default
+    # ones - recent versions of tflite_runtime (2.5+) have XNNPACK built in and apply it automatically, in which case the
+    # separate library won't exist and we just use the normal interpreter (look for "Created TensorFlow Lite XNNPACK
+    # delegate" in the console output to check)
+    try:
+        # N.B. The interpreter's num_threads doesn't apply to a delegate we load ourselves, so it needs telling separately
+        delegates = [load_delegate(XNNPACK_LIBRARY, {"num_threads": DETECTION_THREADS})]
+        log.info("Using XNNPACK delegate for object detection")
+    except (ValueError, OSError):
+        delegates = []
+
+    # By default the model only runs on one core, spreading it across the others makes detection several times faster
+    try:
+        interpreter = Interpreter(model_path=PATH_TO_CKPT, experimental_delegates=delegates, num_threads=DETECTION_THREADS)
+    except TypeError:
+        interpreter = Interpreter(model_path=PATH_TO_CKPT, experimental_delegates=delegates) # Versions before 2.3 don't have num_threads
+    log.debug("Object detection using %i threads", DETECTION_THREADS)
+    interpreter.allocate_tensors()
+
+    # Get model details
+    input_details = interpreter.get_input_details()
+    output_details = interpreter.get_output_details()
+    height = input_details[0]['shape'][1]
+    width = input_details[0]['shape'][2]
+
+    floating_model = (input_details[0]['dtype'] == np.float32)
+
+    # Rather than making new arrays for every frame, the frame is resized into these buffers and then written straight
+    # into the interpreter's own input buffer, which input_tensor() returns a view of
+    input_tensor = interpreter.tensor(input_details[0]['index'])
+    resized_buffer = np.empty((height, width, 3), dtype = np.uint8)
+    rgb_buffer = np.empty((height, width, 3), dtype = np.uint8) if floating_model else None # Only needed before normalising
+
+    # Likewise, these return views of the interpreter's output buffers, which unlike get_tensor() don't copy the whole output
+    boxes_tensor   = interpreter.tensor(output_details[0]['index']) # Bounding box coordinates of detected objects
+    classes_tensor = interpreter.tensor(output_details[1]['index']) # Class index of detected objects
+    scores_tensor  = interpreter.tensor(output_details[2]['index']) # Confidence of detected objects
+
 # Define target method for object detection thread
 def run():
     
     log.info("Object detection thread started")
     
+    # Keep object detection (which will happily use every core it can get) off core 0, leaving that for the main loop,
+    # camera and GPIO threads so that detection doesn't hold up the capture
+    # On Linux this only applies to the calling thread (and any threads it starts afterwards), not the whole program, which
+    # is why the model isn't loaded until after this - TensorFlow starts its worker threads while loading it
+    try:
+        cores = os.sched_getaffinity(0) - {0}
+        if cores:
+            os.sched_setaffinity(0, cores)
+            log.debug("Object detection thread running on CPU cores %s", sorted(cores))
+    except (AttributeError, OSError):
+        log.debug("Unable to set CPU affinity for object detection thread") # Not supported on this platform
+    
+    try:
+        load_model()
+    except Exception:
+        # Carry on recording without object detection rather than stopping the whole program
+        log.exception("Unable to load object detection model, object detection is disabled")
+        return
+    
     time.sleep(1)
     
     while not shutdown_flag:
-        if(camera.is_capturing()):
+        # Save processing power when not capturing by waiting until the camera starts, which also means detection starts
+        # as soon as the first frame is available (the timeout is so the thread still notices when it's shut down)
+        if camera.wait_for_capture(timeout = 1.0):
             process_next()
-        else:
-            time.sleep(0.2) # Save processing power when not capturing
         
     log.info("Object detection thread stopping")
 
@@ -108,47 +191,69 @@ def shutdown():
     global shutdown_flag
     shutdown_flag = True
 
+def latest():
+    """
+    Returns the results of the latest detection cycle as a Detections tuple of (boxes, labels, scores), all of which
+    belong to the same cycle.
+    """
+    return detections
+
 def process_next():
     """
-    Performs object detection on the latest frame from the camera feed and updates the global variables with the results.
+    Performs object detection on the latest frame from the camera feed and updates the latest detections with the results.
     """
+    global detections
+    
     # Get latest frame from camera stream
-    frame = camera.raw_frame.copy()
+    # No need to copy it, the camera manager never modifies a raw frame once it has been captured (see capture_frame())
+    frame = camera.raw_frame
 
     # Resize to expected shape [1xHxWx3]
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    frame_resized = cv2.resize(frame_rgb, (width, height))
-    input_data = np.expand_dims(frame_resized, axis=0)
-
+    # N.B. Resizing first means the colour conversion only has to be done on the much smaller resized frame - the result
+    # is exactly the same either way since resizing treats each channel separately
+    if camera.USE_OPENCL:
+        # Where OpenCL is available (not on the pi) the resize can be done on the GPU, and only the small resized frame
+        # has to be copied back
+        np.copyto(resized_buffer, cv2.resize(cv2.UMat(frame), (width, height)).get())
+    else:
+        cv2.resize(frame, (width, height), dst = resized_buffer)
+    input_data = input_tensor()[0] # The model's input buffer, so anything written to this is the input
+    
     # Normalize pixel values if using a floating model (i.e. if model is non-quantized)
     if floating_model:
-        input_data = (np.float32(input_data) - input_mean) / input_std
+        cv2.cvtColor(resized_buffer, cv2.COLOR_BGR2RGB, dst = rgb_buffer)
+        np.subtract(rgb_buffer, input_mean, out = input_data, dtype = np.float32)
+        np.divide(input_data, input_std, out = input_data)
+    else:
+        cv2.cvtColor(resized_buffer, cv2.COLOR_BGR2RGB, dst = input_data)
+    
+    # The interpreter won't run while anything still references its internal buffers, so the view has to go first
+    del input_data
 
     # Perform the actual detection by running the model with the image as input
-    interpreter.set_tensor(input_details[0]['index'],input_data)
     interpreter.invoke()
 
-    global boxes
-    global labels
-    global label_map
-    global scores
-    
     # Retrieve detection results
-    boxes = interpreter.get_tensor(output_details[0]['index'])[0] # Bounding box coordinates of detected objects
-    classes = interpreter.get_tensor(output_details[1]['index'])[0] # Class index of detected objects
-    labels = np.array(label_map)[classes.astype(int)] # Convert classes to labels
-    scores = interpreter.get_tensor(output_details[2]['index'])[0] # Confidence of detected objects
+    # N.B. These are views of the interpreter's buffers, which the next cycle will overwrite - the indexing below makes
+    # copies of the results we keep, and the views themselves all go when this function returns
+    scores = scores_tensor()[0]
 
-    # Remove results that are below the confidence threshold
+    # Remove results that are below the confidence threshold or not in the list of valid objects
+    # The other outputs are only looked at if something passed the threshold
     idx = scores > settings.CONFIDENCE_THRESHOLD
-    boxes = boxes[idx]
-    labels = labels[idx]
-    scores = scores[idx]
+    if idx.any():
+        classes = classes_tensor()[0].astype(int)
+        idx &= valid_classes[classes]
     
-    # Remove results that are not in the list of valid objects
-    idx = [label in settings.VALID_OBJECTS for label in labels]
-    boxes = boxes[idx]
-    labels = labels[idx]
+    if not idx.any(): # Nothing found, so there's no need to make any new arrays
+        detections = NO_DETECTIONS
+        log.debug("Detected 0 objects")
+        return
+        
+    boxes = boxes_tensor()[0][idx]
+    labels = label_array[classes[idx]] # Convert classes to labels
     scores = scores[idx]
     
+    detections = Detections(boxes, labels, scores)
+    
     log.debug("Detected %i objects", labels.size)
\ No newline at end of file
@@ -7,6 +7,9 @@ This module is responsible for reading and storing the program settings.
 import logging as log
 import json  # JSON file parsing
 import os
+import atexit                  # Cleanup on exit
+import queue                   # Thread-safe queue
+from logging.handlers import QueueHandler, QueueListener, MemoryHandler # Logging from a separate thread
 from datetime import datetime  # Real-world date and time
 
 ### Constants ###
@@ -38,6 +41,10 @@ IDLE_TIME = 20 # If no objects are detected in the camera feed for this many sec
 FRAME_BUFFER_SIZE = 150 # Maximum number of frames the buffer can hold; prevents overloading the RAM
 FRAMERATE = 10          # Target framerate to capture at, in frames per second
 
+# JPEG quality (1-100) to compress frames with while they are in the buffer, or 0 to store them uncompressed
+# Compressing them takes up about a tenth of the RAM (so the buffer can be made much bigger), but costs some CPU time
+BUFFER_JPEG_QUALITY = 0
+
 # Image filtering
 
 LUMA_THRESHOLD = 4            # Threshold used to make darkest areas uniform; avoids large grey artefacts after equalisation
@@ -59,15 +66,34 @@ OBJECT_WHITELIST = ["scissors"]
 
 ### Setup ###
 
+# Writing to the log file and console is done by a separate thread, so that logging never holds up the thread doing the
+# logging while it waits for the USB drive - the messages are just put in a queue for the logging thread to deal with
+log_queue = queue.Queue()
+
+# Write to a log file (which is opened by the logging thread when the first message is written, rather than here)
+log_file_handler = log.FileHandler(f"{SAVE_DIRECTORY}/logs/{datetime.now().strftime('%Y-%m-%d_%H%M')}.log", delay = True)
+# Messages for the log file are saved up and written to the drive in batches rather than one at a time, but warnings and
+# errors are written straight away (along with everything before them) so they don't get lost if something goes wrong
+log_file_buffer = MemoryHandler(64, flushLevel = log.WARNING, target = log_file_handler)
+
+log_listener = QueueListener(log_queue,
+                             log_file_buffer,
+                             log.StreamHandler()) # Print to console as well
+log_listener.start()
+atexit.register(log_listener.stop) # Make sure all the queued messages get written before exiting
+
 # Must set up logger before importing our own modules or it won't work properly
+# N.B. The messages are formatted before they go in the queue, so the format only needs setting here
 log.basicConfig(format = "%(asctime)s [%(levelname)s] %(message)s",
                 datefmt = "%d-%m-%Y %I:%M:%S %p",
                 level = log.DEBUG if DEV_MODE else log.INFO,
-                handlers = [
-                    # Print to console and write to a log file
-                    log.FileHandler(f"{SAVE_DIRECTORY}/logs/{datetime.now().strftime('%Y-%m-%d_%H%M')}.log"),
-                    log.StreamHandler()
-                ])
+                handlers = [QueueHandler(log_queue)])
+
+# None of the thread, process or source file details are included in the log format, so don't waste time collecting them
+# for every message (see https://docs.python.org/3/howto/logging.html#optimization)
+log.logThreads = False
+log.logProcesses = False
+log._srcfile = None
 
 log.info("*** Lookout started ***")
 
@@ -86,6 +112,7 @@ try:
     
     FRAME_BUFFER_SIZE      = settings["frame_buffer_size"]
     FRAMERATE              = settings["framerate"]
+    BUFFER_JPEG_QUALITY    = settings.get("buffer_jpeg_quality", BUFFER_JPEG_QUALITY) # Older config files won't have this
     LUMA_THRESHOLD         = settings["luma_threshold"]
     HISTOGRAM_EQUALISATION = settings["histogram_equalisation"]
     CONFIDENCE_THRESHOLD   = settings["confidence_threshold"]
@@ -97,4 +124,16 @@ try:
 except json.JSONDecodeError:
     log.error("Error opening config.json, using default setting values instead")
 except KeyError:
-    log.error("config.json is missing one or more keys, using default setting values instead")
\ No newline at end of file
+    log.error("config.json is missing one or more keys, using default setting values instead")
+
+### Functions ###
+
+def flush_log():
+    """
+    Waits for all the log messages so far to be written out. This happens automatically when the program exits, but it
+    needs doing before shutting the pi down since that doesn't give Python a chance to exit normally.
+    """
+    # Stopping the listener waits for the queue to be emptied, then it can just be started again
+    log_listener.stop()
+    log_file_buffer.flush() # Write out any messages that are still waiting to go in the log file
+    log_listener.start()